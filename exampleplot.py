@@ -21,35 +21,41 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see https://www.gnu.org/licenses/
 """
 import os
-from collections.abc import Iterable, Generator, Sequence
-from typing import Any, TypeVar
+from collections.abc import Generator, Sequence
+from typing import Any
 import matplotlib as mp
 import matplotlib.pyplot as plt
 import numpy as np
 from tifffile import TiffFile
-from djixt2tiff import pageprops, props2json
-
-# a simple utility function to get a specific item from an iterable
-_T = TypeVar('_T')
-def iter_nth(iterable :Iterable[_T], n :int) -> _T:
-    from itertools import islice
-    return next(islice(iterable, n, n+1))
+from djixt2tiff import WGS84Coords, check_make_model, convert_gpstags, pageprops, props2json
 
 # generator function to access image files (doesn't actually load *all* images unless requested)
 def allimgs(files :Sequence[str|os.PathLike]) -> Generator[tuple[np.ndarray, dict[str, Any]]]:
     for fn in files:
         with TiffFile(fn) as tif:
+            # the camera doesn't change within a file, so only check it once
+            check_make_model(tif.pages[0])
             for idx, page in enumerate(tif.pages):
-                yield page.asarray(), pageprops(idx=idx, page=page)
+                yield page.asarray(), pageprops(idx=idx, page=page, skip_make_check=True)
+
+# https://matplotlib.org/stable/api/_as_gen/matplotlib.colors.Colormap.html
+# https://matplotlib.org/stable/tutorials/colors/colormaps.html
+# this colormap doesn't contain green, but we also don't expect any "bad" pixels
+# (built once here instead of on every display_image call)
+_CMAP = mp.colormaps['plasma'].with_extremes(under="white", over="black", bad="green")
 
 def display_image(*, file :str|os.PathLike, index :int, width_in :float):
-    imgs = allimgs([file])
-    data, props = iter_nth(imgs, index)
+    # only decode the requested page, instead of walking allimgs() and decoding every page before it
+    with TiffFile(file) as tif:
+        page = tif.pages[index]
+        data, props = page.asarray(), pageprops(idx=index, page=page)
 
     print(props2json(props))  # print the image properties as JSON
 
-    # Convert pixel values to temperatures
-    img :np.ndarray = data.astype(np.float64) * float(props['TlinearGain']) - 273.15
+    # Convert pixel values to temperatures (float32 is plenty for 16-bit sensor data; in-place to avoid temporaries)
+    img :np.ndarray = data.astype(np.float32)
+    np.multiply(img, np.float32(props['TlinearGain']), out=img)
+    np.subtract(img, np.float32(273.15), out=img)
 
     # calculate some statistics (optional)
     stddev = np.std(img)
@@ -59,28 +65,36 @@ def display_image(*, file :str|os.PathLike, index :int, width_in :float):
     # setting vmin and vmax is optional, we're just doing it to demonstrate the "over" and "under" values in the colormap!
     norm = mp.colors.Normalize(vmin=avg-stddev*2, vmax=avg+stddev*2)
 
-    # https://matplotlib.org/stable/api/_as_gen/matplotlib.colors.Colormap.html
-    # https://matplotlib.org/stable/tutorials/colors/colormaps.html
-    # this colormap doesn't contain green, but we also don't expect any "bad" pixels
-    cmap = mp.cm.get_cmap('plasma').with_extremes(under="white", over="black", bad="green")
-
     # calculate figure height from width based on aspect ratio
     height_in = (width_in / props['ImageWidth']) * props['ImageLength']
     height_in /= 1.15  # a bit of extra space for the colorbar
 
     # generate the figure
     plt.figure(figsize=(width_in, height_in), layout='constrained')
-    plt.imshow(img, norm=norm, cmap=cmap, interpolation='none')
+    plt.imshow(img, norm=norm, cmap=_CMAP, interpolation='none')
     plt.colorbar()
     plt.show()
 
+# print the coordinates of all images in a file, converting the GPS data of all pages at once
+def print_coords(*, file :str|os.PathLike):
+    with TiffFile(file) as tif:
+        check_make_model(tif.pages[0])
+        gps = [ (idx, page.tags.get(34853)) for idx, page in enumerate(tif.pages) ]  # GPSTag
+        gps = [ (idx, tag) for idx, tag in gps if tag is not None ]
+        coords = convert_gpstags( tag for _, tag in gps )
+    for (idx, _), c in zip(gps, coords):
+        print(f"{idx},{WGS84Coords(*c)}")
+
 if __name__ == '__main__':
     import sys
     import argparse
     parser = argparse.ArgumentParser(description='Display DJI XT2 Images')
-    parser.add_argument('-i', '--index', help='image index (0-based)', type=int, required=True)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-i', '--index', help='image index (0-based)', type=int)
+    group.add_argument('-c', '--coords', help="print the coordinates of all images instead", action='store_true')
     parser.add_argument('-w', '--width', help="figure display width in inches", type=float, default=10)
     parser.add_argument('file', metavar="TIFFFILE", help="input TIFF file")
     args = parser.parse_args()
-    display_image(file=args.file, index=args.index, width_in=args.width)
+    if args.coords: print_coords(file=args.file)
+    else: display_image(file=args.file, index=args.index, width_in=args.width)
     sys.exit(0)